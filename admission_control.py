@@ -0,0 +1,319 @@
+# Module with the admission control in front of the trial maker
+
+##########################################################################################
+# Imports
+##########################################################################################
+
+import time
+
+from typing import (
+    Callable, Union
+)
+
+from dallinger.db import redis_conn
+
+from psynet.page import UnsuccessfulEndPage, WaitPage
+from psynet.participant import Participant
+from psynet.trial.main import Trial
+from psynet.timeline import (
+    CodeBlock,
+    PageMaker,
+    conditional,
+    join,
+    while_loop,
+)
+from psynet.utils import get_logger
+
+logger = get_logger()
+
+CAPACITY_FAILURE_TAG = "capacity_reached"
+
+ADMITTED = "admitted"
+WAITING = "waiting"
+FULL = "full"
+
+MAX_DURATIONS = 20
+
+
+###########################################
+# Redis scripts
+###########################################
+
+# KEYS: waiting, seen, active, completed, seq
+# ARGV: participant_id, now, capacity, concurrent_slots, stale_s
+# Returns 1 if admitted, 0 if waiting and -1 if the run is full.
+ADMIT_SCRIPT = """
+local waiting, seen, active, completed, seq = KEYS[1], KEYS[2], KEYS[3], KEYS[4], KEYS[5]
+local pid = ARGV[1]
+local now = tonumber(ARGV[2])
+local capacity = tonumber(ARGV[3])
+local concurrent = tonumber(ARGV[4])
+local stale_s = tonumber(ARGV[5])
+
+for _, p in ipairs(redis.call('ZRANGEBYSCORE', seen, '-inf', now - stale_s)) do
+    redis.call('ZREM', waiting, p)
+    redis.call('ZREM', seen, p)
+end
+
+if redis.call('ZSCORE', active, pid) then
+    return 1
+end
+
+local n_active = redis.call('ZCARD', active)
+local taken = n_active + redis.call('SCARD', completed)
+if taken >= capacity then
+    redis.call('ZREM', waiting, pid)
+    redis.call('ZREM', seen, pid)
+    return -1
+end
+
+if not redis.call('ZSCORE', waiting, pid) then
+    redis.call('ZADD', waiting, redis.call('INCR', seq), pid)
+end
+redis.call('ZADD', seen, now, pid)
+
+local free = math.min(concurrent - n_active, capacity - taken)
+if redis.call('ZRANK', waiting, pid) < free then
+    redis.call('ZREM', waiting, pid)
+    redis.call('ZREM', seen, pid)
+    redis.call('ZADD', active, now, pid)
+    return 1
+end
+return 0
+"""
+
+# KEYS: waiting, seen, active, completed, durations
+# ARGV: participant_id, now, max_durations, completed (1 or 0)
+# Participants who leave without completing a trial give their slot back.
+RELEASE_SCRIPT = """
+local waiting, seen, active, completed, durations = KEYS[1], KEYS[2], KEYS[3], KEYS[4], KEYS[5]
+local pid = ARGV[1]
+redis.call('ZREM', waiting, pid)
+redis.call('ZREM', seen, pid)
+local start = redis.call('ZSCORE', active, pid)
+if start then
+    redis.call('ZREM', active, pid)
+end
+if start and ARGV[4] == '1' then
+    redis.call('SADD', completed, pid)
+    redis.call('LPUSH', durations, tonumber(ARGV[2]) - tonumber(start))
+    redis.call('LTRIM', durations, 0, tonumber(ARGV[3]) - 1)
+end
+return 0
+"""
+
+
+###########################################
+# Slot counter
+###########################################
+
+def has_finished_trial(participant, trial_maker) -> bool:
+    return Trial.query.filter_by(
+        participant_id=participant.id,
+        trial_maker_id=trial_maker.id,
+        failed=False,
+        finalized=True,
+    ).count() > 0
+
+
+def participant_is_working(participant_id: int) -> bool:
+    participant = Participant.query.filter_by(id=participant_id).one_or_none()
+    return (
+        participant is not None
+        and not participant.failed
+        and participant.status == "working"
+    )
+
+
+class SlotCounter:
+    """
+    Counter of the participant slots available in a run, kept in Redis so
+    that every server process sees the same count.
+
+    ``capacity`` is the total number of participants the chains can take
+    and ``concurrent_slots`` how many of them can be active at once.
+    Waiting participants are admitted in order of arrival; those who stop
+    polling for ``stale_s`` seconds leave the queue. Active slots older
+    than ``lease_s`` are only given back if the participant is no longer
+    working, so nobody loses their slot while still in the trial maker.
+    """
+
+    def __init__(
+            self,
+            name: str,
+            capacity: int,
+            concurrent_slots: int,
+            lease_s: float = 600.0,
+            stale_s: float = 30.0,
+            default_duration_s: float = 60.0,
+            redis=redis_conn,
+            is_working: Callable[[int], bool] = participant_is_working,
+            clock: Callable[[], float] = time.time,
+        ) -> None:
+        assert capacity > 0, f"Error: capacity should be positive but got {capacity}!"
+        assert concurrent_slots > 0, f"Error: concurrent_slots should be positive but got {concurrent_slots}!"
+        self.name = name
+        self.capacity = capacity
+        self.concurrent_slots = concurrent_slots
+        self.lease_s = lease_s
+        self.stale_s = stale_s
+        self.default_duration_s = default_duration_s
+        self.redis = redis
+        self.is_working = is_working
+        self.clock = clock
+        self._admit = redis.register_script(ADMIT_SCRIPT)
+        self._release = redis.register_script(RELEASE_SCRIPT)
+
+    def _key(self, suffix: str) -> str:
+        return f"admission_control:{self.name}:{suffix}"
+
+    def reset(self) -> None:
+        self.redis.delete(*[
+            self._key(suffix)
+            for suffix in ["waiting", "seen", "active", "completed", "seq", "durations"]
+        ])
+
+    def expire_leases(self) -> None:
+        now = self.clock()
+        active = self._key("active")
+        for pid in self.redis.zrangebyscore(active, "-inf", now - self.lease_s):
+            pid = int(pid)
+            if self.is_working(pid):
+                self.redis.zadd(active, {pid: now}, xx=True)
+            else:
+                logger.info(f"Lease of participant {pid} expired, releasing slot")
+                self.redis.zrem(active, pid)
+
+    def is_full(self) -> bool:
+        n_taken = self.redis.zcard(self._key("active")) + self.redis.scard(self._key("completed"))
+        return n_taken >= self.capacity
+
+    def try_admit(self, participant_id: int, open_slots: Union[int, None] = None) -> str:
+        """
+        Admits the participant if they are among the first waiting
+        participants that fit in the free slots, otherwise puts them in
+        the waiting room. ``open_slots`` further limits how many
+        participants can be active at this moment. Returns ADMITTED,
+        WAITING or FULL.
+        """
+        self.expire_leases()
+        concurrent_slots = self.concurrent_slots
+        if open_slots is not None:
+            concurrent_slots = min(concurrent_slots, open_slots)
+        result = self._admit(
+            keys=[self._key(k) for k in ["waiting", "seen", "active", "completed", "seq"]],
+            args=[participant_id, self.clock(), self.capacity, concurrent_slots, self.stale_s],
+        )
+        if result == 1:
+            logger.info(f"Admitted participant {participant_id}")
+            return ADMITTED
+        if result == 0:
+            return WAITING
+        return FULL
+
+    def release(self, participant_id: int, completed: bool = True) -> None:
+        """
+        Gives up the participant's slot. Only participants who ``completed``
+        a trial count towards the capacity of the run.
+        """
+        self._release(
+            keys=[self._key(k) for k in ["waiting", "seen", "active", "completed", "durations"]],
+            args=[participant_id, self.clock(), MAX_DURATIONS, int(completed)],
+        )
+
+    def leave_waiting_room(self, participant_id: int) -> None:
+        self.redis.zrem(self._key("waiting"), participant_id)
+        self.redis.zrem(self._key("seen"), participant_id)
+
+    def estimated_wait(self, participant_id: int) -> float:
+        """
+        Estimated seconds until the participant gets a slot, from their
+        place in the queue and the mean duration of recent sessions.
+        """
+        position = self.redis.zrank(self._key("waiting"), participant_id)
+        if position is None:
+            position = 0
+        durations = [float(d) for d in self.redis.lrange(self._key("durations"), 0, -1)]
+        if len(durations) > 0:
+            mean_duration = sum(durations) / len(durations)
+        else:
+            mean_duration = self.default_duration_s
+        return mean_duration * (position // self.concurrent_slots + 1)
+
+
+###########################################
+# Timeline logic
+###########################################
+
+def waiting_room_page(counter: SlotCounter, participant, wait_time: float) -> WaitPage:
+    estimate = counter.estimated_wait(participant.id)
+    return WaitPage(
+        wait_time=wait_time,
+        content=f"All places are taken at the moment. Estimated wait: {round(estimate)} seconds.",
+    )
+
+
+def admission_control(
+        label: str,
+        trial_maker,
+        counter: SlotCounter,
+        open_slots: Union[Callable[[], int], None] = None,
+        wait_time: float = 5.0,
+        max_wait_s: float = 300.0,
+    ):
+    """
+    Wraps ``trial_maker`` so that participants only enter it when the
+    counter gives them a slot. Arrivals beyond the run capacity are
+    rejected straight away; the rest wait until a slot is free or
+    ``max_wait_s`` runs out. ``open_slots``, if given, returns how many
+    participants the trial maker can take at this moment.
+    """
+    assert counter.stale_s > wait_time, "Error: stale_s should be longer than wait_time!"
+
+    def holds_slot(participant) -> bool:
+        return participant.var.get("admitted", False)
+
+    def should_wait(participant) -> bool:
+        if counter.is_full():
+            participant.var.set("admitted", False)
+            return False
+        result = counter.try_admit(
+            participant.id,
+            open_slots() if open_slots is not None else None,
+        )
+        participant.var.set("admitted", result == ADMITTED)
+        return result == WAITING
+
+    def release(participant) -> None:
+        counter.release(participant.id, completed=has_finished_trial(participant, trial_maker))
+
+    def leave(participant) -> None:
+        counter.leave_waiting_room(participant.id)
+
+    return join(
+        while_loop(
+            f"{label}_waiting_room",
+            should_wait,
+            PageMaker(
+                lambda participant: waiting_room_page(counter, participant, wait_time),
+                time_estimate=wait_time,
+            ),
+            expected_repetitions=0,
+            max_loop_time=max_wait_s,
+            fail_on_timeout=False,
+        ),
+        conditional(
+            f"{label}_admission",
+            holds_slot,
+            join(
+                trial_maker,
+                CodeBlock(release),
+            ),
+            join(
+                CodeBlock(leave),
+                UnsuccessfulEndPage(failure_tags=[CAPACITY_FAILURE_TAG]),
+            ),
+        ),
+    )
+
+###########################################
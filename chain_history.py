@@ -0,0 +1,106 @@
+# Module with lazy, paginated access to the history of a chain
+
+##########################################################################################
+# Imports
+##########################################################################################
+
+from typing import (
+    List, Dict, Any, Union
+)
+
+from psynet.trial.chain import ChainNode, ChainTrial
+from psynet.trial.create_and_rate import CreateAndRateNode
+from psynet.utils import get_logger
+
+logger = get_logger()
+
+HISTORY_PAGE_SIZE = 5
+SUMMARY_VAR = "generation_summary"
+
+
+###########################################
+# Generation summaries
+###########################################
+
+def resolve_positions(definition: Any) -> Union[List[int], None]:
+    """
+    Returns the list of forager positions stored in a node definition.
+    With rate_mode="select" the definition is the selected target, which
+    is either a coordinator trial or the previous node (when
+    include_previous_iteration=True). A previous node is resolved through
+    its own summary, which is computed and cached on the way if needed.
+    """
+    if isinstance(definition, ChainTrial):
+        definition = definition.answer
+    elif isinstance(definition, ChainNode):
+        return summarize_generation(definition)["positions"]
+    if isinstance(definition, list):
+        return definition
+    return None
+
+
+def summarize_generation(node: CreateAndRateNode) -> Dict[str, Any]:
+    """
+    Returns a compact summary of a generation, computed once per node and
+    cached in its vars so that later reads do not touch the ORM graph.
+    """
+    summary = node.var.get(SUMMARY_VAR, None)
+    if summary is None:
+        summary = {
+            "node_id": node.id,
+            "degree": node.degree,
+            "positions": resolve_positions(node.definition),
+        }
+        node.var.set(SUMMARY_VAR, summary)
+    return summary
+
+
+###########################################
+# Paginated history
+###########################################
+
+def _previous_nodes_query(node: CreateAndRateNode):
+    return (
+        CreateAndRateNode.query
+        .filter(
+            CreateAndRateNode.network_id == node.network_id,
+            CreateAndRateNode.degree < node.degree,
+            CreateAndRateNode.failed == False,  # noqa: E712
+        )
+        .order_by(CreateAndRateNode.degree.desc())
+    )
+
+
+def get_chain_history(
+        node: CreateAndRateNode,
+        page: int = 0,
+        page_size: int = HISTORY_PAGE_SIZE,
+    ) -> List[Dict[str, Any]]:
+    """
+    Returns one page of generation summaries preceding ``node``, most
+    recent first. Only ``page_size`` nodes are loaded per call.
+    """
+    assert page >= 0, f"Error: page should be non-negative but got {page}!"
+    assert page_size > 0, f"Error: page_size should be positive but got {page_size}!"
+    nodes = (
+        _previous_nodes_query(node)
+        .offset(page * page_size)
+        .limit(page_size)
+        .all()
+    )
+    # Summarize oldest first so that each node's summary is cached before
+    # a more recent node that selected it needs it
+    summaries = [summarize_generation(n) for n in reversed(nodes)]
+    return summaries[::-1]
+
+
+def format_chain_history(summaries: List[Dict[str, Any]]) -> str:
+    if len(summaries) == 0:
+        return "There are no previous generations yet."
+    lines = [
+        f"Generation {s['degree']}: {s['positions'] if s['positions'] is not None else 'no positions'}"
+        for s in summaries
+    ]
+    return "<br>".join(lines)
+
+###########################################
@@ -9,6 +9,8 @@ from typing import (
 )
 from markupsafe import Markup
 
+from dallinger import db
+
 import psynet.experiment
 from psynet.page import  InfoPage
 from psynet.utils import get_logger
@@ -35,8 +37,18 @@ from psynet.trial.imitation_chain import (
     ImitationChainTrialMaker
 )
 
-from .helper_functions import (
-    get_list_participants_ids,
+from .chain_history import (
+    get_chain_history,
+    format_chain_history,
+)
+from .admission_control import (
+    SlotCounter,
+    admission_control,
+    CAPACITY_FAILURE_TAG,
+)
+from .forager_storage import (
+    write_coordinator_slots,
+    write_forager_slot,
 )
 from .custom_front_end import (
     positioning_prompt,
@@ -47,6 +59,8 @@ from .custom_front_end import (
 logger = get_logger()
 
 NUM_FORAGERS = 3
+NUM_CHAINS = 1
+TRIAL_MAKER_ID = "create_and_rate_basic"
 
 
 ###########################################
@@ -102,17 +116,18 @@ class CoordinatorTrial(CreateTrialMixin, ImitationChainTrial):
     def show_trial(self, experiment, participant) -> List[Any]:
         logger.info("Entering the coordinator trial...")
         experiment.var.set("forager_counter", 0)
+        # Only the most recent generations are loaded, however long the chain
+        history = get_chain_history(self.node)
         list_of_pages = [
             InfoPage(
                 "This is going to be the Instructions page for the COORDINATOR",
                 time_estimate=5
             ),
-            AssignForagersPage(
-                context=self.context,
-                num_foragers=NUM_FORAGERS,
-                time_estimate=self.time_estimate,
-                bot_response="23, 42" 
+            InfoPage(
+                Markup(f"Previous generations:<br>{format_chain_history(history)}"),
+                time_estimate=5
             ),
+            self.assign_foragers_page(self.context),
             ModularPage(
                 "test_custom_front_end",
                 HelloPrompt(
@@ -126,6 +141,19 @@ class CoordinatorTrial(CreateTrialMixin, ImitationChainTrial):
             ),
         ]
         return list_of_pages
+
+    @classmethod
+    def assign_foragers_page(cls, context: Any) -> AssignForagersPage:
+        return AssignForagersPage(
+            context=context,
+            num_foragers=cls.num_foragers,
+            time_estimate=cls.time_estimate,
+            bot_response="23, 42" 
+        )
+
+    def on_finalized(self):
+        super().on_finalized()
+        write_coordinator_slots(self)
     
 ###########################################
 
@@ -161,15 +189,15 @@ class ForagerTrial(SelectTrialMixin, ImitationChainTrial):
         # Get participant info
         logger.info(f"My id is: {participant.id}")
 
-        # Get list of previous participants
-        participants_id = get_list_participants_ids(experiment, participant)
-        # Calculate id based on number of previous non failed participants
-        forager_id = (len(participants_id) % (NUM_FORAGERS + 1)) - 1
+        # Take a free slot among the foragers of this node
+        forager_id = self.assign_forager_slot()
 
         logger.info(f"forager id: {forager_id}")
 
         # Extract forager position
         location = positions[forager_id]
+        self.var.set("forager_id", forager_id)
+        self.var.set("location", location)
         
         list_of_pages = [
             # InfoPage(
@@ -189,21 +217,71 @@ class ForagerTrial(SelectTrialMixin, ImitationChainTrial):
                 # ),
                 # time_estimate=self.time_estimate
             # ),
-            ModularPage(
-                "forager_turn",
-                positioning_prompt(
-                    text=f"You have been located here:<br><strong>{location}</strong>",
-                    img_url=self.context["img_url"],
-                ),
-                PushButtonControl(
-                    choices=[f"{target}" for target in targets],
-                    labels=["Continue"],
-                    arrange_vertically=False,
-                ),
-                time_estimate=self.time_estimate
+            self.forager_turn_page(
+                context=self.context,
+                location=location,
+                choices=[f"{target}" for target in targets],
             ),
         ]
         return list_of_pages
+
+    @classmethod
+    def forager_turn_page(cls, context: Any, location: int, choices: List[str]) -> ModularPage:
+        return ModularPage(
+            "forager_turn",
+            positioning_prompt(
+                text=f"You have been located here:<br><strong>{location}</strong>",
+                img_url=context["img_url"],
+            ),
+            PushButtonControl(
+                choices=choices,
+                labels=["Continue"],
+                arrange_vertically=False,
+            ),
+            time_estimate=cls.time_estimate
+        )
+
+    def assign_forager_slot(self) -> int:
+        forager_id = self.var.get("forager_id", None)
+        if forager_id is not None:
+            return forager_id
+        foragers = [
+            (trial.id, trial.var.get("forager_id", None))
+            for trial in ForagerTrial.query.filter(
+                ForagerTrial.node_id == self.node_id,
+                ForagerTrial.id != self.id,
+                ForagerTrial.failed == False,  # noqa: E712
+            ).all()
+        ]
+        return self.pick_forager_slot(self.id, foragers + [(self.id, None)])
+
+    @staticmethod
+    def pick_forager_slot(trial_id: int, foragers: List[Tuple[int, Union[int, None]]]) -> int:
+        """
+        ``foragers`` holds (trial id, slot or None) for the non-failed forager
+        trials of a node. Slots already taken are kept, and trials without one
+        get the free slots in order of trial id. Foragers that start at the
+        same time therefore agree on their slots without any locking.
+        """
+        taken = {slot for _, slot in foragers if slot is not None}
+        free = [slot for slot in range(NUM_FORAGERS) if slot not in taken]
+        unassigned = sorted(id_ for id_, slot in foragers if slot is None)
+        rank = unassigned.index(trial_id)
+        assert(rank < len(free)), f"Error: No free forager slot for trial {trial_id}!"
+        return free[rank]
+
+    def on_finalized(self):
+        super().on_finalized()
+        target_ids = {
+            f"{target}": target.id for target in self.targets
+            if isinstance(target, CoordinatorTrial)
+        }
+        write_forager_slot(
+            self,
+            slot=self.var.get("forager_id"),
+            position=self.var.get("location"),
+            target_id=target_ids.get(self.answer),
+        )
 ###########################################
 
 
@@ -228,6 +306,7 @@ def get_trial_maker():
             context={"img_url": "static/positioning.png"}, 
             seed="initial creation"
         )
+        for _ in range(NUM_CHAINS)
     ]
 
     return CreateAndRateTrialMaker(
@@ -242,7 +321,7 @@ def get_trial_maker():
         target_selection_method=target_selection_method,
         verbose=True,  # for the demo
         # trial_maker params
-        id_="create_and_rate_basic",
+        id_=TRIAL_MAKER_ID,
         chain_type="across",
         expected_trials_per_participant=len(start_nodes),
         max_trials_per_participant=len(start_nodes),
@@ -258,6 +337,38 @@ def get_trial_maker():
         max_nodes_per_chain=NUM_FORAGERS,
     )
 
+def open_slots() -> int:
+    """
+    How many participants the chains can take right now. Until the coordinator
+    trial of a chain's newest node is finalized only the coordinator is let in,
+    since the trial maker would send foragers away without a trial.
+    """
+    n_slots = 0
+    network_ids = (
+        db.session.query(CreateAndRateNode.network_id)
+        .filter_by(trial_maker_id=TRIAL_MAKER_ID, failed=False)
+        .distinct()
+    )
+    for (network_id,) in network_ids:
+        head = (
+            CreateAndRateNode.query
+            .filter_by(network_id=network_id, failed=False)
+            .order_by(CreateAndRateNode.degree.desc())
+            .first()
+        )
+        coordinated = CoordinatorTrial.query.filter_by(
+            node_id=head.id, failed=False, finalized=True
+        ).count() > 0
+        n_slots += 1 + NUM_FORAGERS if coordinated else 1
+    return n_slots
+
+# One coordinator and NUM_FORAGERS foragers per generation
+slot_counter = SlotCounter(
+    "forager_slots",
+    capacity=NUM_CHAINS * NUM_FORAGERS * (1 + NUM_FORAGERS),
+    concurrent_slots=NUM_CHAINS * (1 + NUM_FORAGERS),
+)
+
 class Exp(psynet.experiment.Experiment):
     label = "Social roles and hierarchies skeleton experiment"
     initial_recruitment_size = 1
@@ -267,9 +378,35 @@ class Exp(psynet.experiment.Experiment):
     }
 
     timeline = Timeline(
-        get_trial_maker(),
+        admission_control(
+            "forager_slots",
+            get_trial_maker(),
+            slot_counter,
+            open_slots=open_slots,
+        ),
     )
 
-    # test_n_bots = 6
+    def on_first_launch(self):
+        super().on_first_launch()
+        # Counts left in Redis by an earlier deployment would otherwise fill the run
+        slot_counter.reset()
+
+    # To load-test admission control, send a burst of bots larger than the capacity
+    # test_n_bots = 16
+    # test_mode = "parallel"
+
+    def test_check_bot(self, bot, **kwargs):
+        if bot.failed:
+            assert CAPACITY_FAILURE_TAG in bot.failure_tags
+        else:
+            super().test_check_bot(bot, **kwargs)
+
+    def test_check_bots(self, bots):
+        super().test_check_bots(bots)
+        n_completed = len([bot for bot in bots if not bot.failed])
+        n_expected = min(len(bots), slot_counter.capacity)
+        assert n_completed >= n_expected, (
+            f"Error: {n_completed} bots completed the experiment but expected at least {n_expected}!"
+        )
 
 ###########################################
\ No newline at end of file
@@ -0,0 +1,147 @@
+# Module with the typed table for forager positions and outcomes
+
+##########################################################################################
+# Imports
+##########################################################################################
+
+from typing import (
+    List, Tuple, Union
+)
+
+from dallinger import db
+from dallinger.models import Info
+from sqlalchemy import Column, ForeignKey, Index, Integer, String, UniqueConstraint, func
+
+from psynet.data import SQLBase, SQLMixin, register_table
+from psynet.utils import get_logger
+
+logger = get_logger()
+
+COORDINATOR_ROLE = "coordinator"
+FORAGER_ROLE = "forager"
+
+
+###########################################
+# Tables
+###########################################
+
+@register_table
+class ForagerSlot(SQLBase, SQLMixin):
+    """
+    One row per (trial, slot, role), indexed by (chain, generation, slot).
+    Coordinator rows hold the position assigned to each slot; forager rows
+    hold the position the forager was shown and the id of the coordinator
+    trial it selected. A trial that fails later keeps its rows, so a
+    replacement trial can take the same slot; the aggregate queries only
+    count rows whose trial has not failed.
+    """
+    __tablename__ = "forager_slot"
+    __table_args__ = (
+        UniqueConstraint("trial_id", "slot", "role", name="uq_forager_slot_trial"),
+        Index("ix_forager_slot_chain", "network_id", "degree", "slot", "role"),
+        Index("ix_forager_slot_role", "role", "network_id"),
+    )
+
+    network_id = Column(Integer, ForeignKey("network.id"), nullable=False)
+    degree = Column(Integer, nullable=False)
+    slot = Column(Integer, nullable=False)
+    role = Column(String(16), nullable=False)
+    trial_id = Column(Integer, ForeignKey("info.id"), nullable=False)
+    participant_id = Column(Integer, ForeignKey("participant.id"))
+    position = Column(Integer)
+    target_id = Column(Integer, ForeignKey("info.id"))
+
+
+###########################################
+# Writers
+###########################################
+
+def write_coordinator_slots(trial) -> None:
+    """
+    Writes the positions of a finalised coordinator trial in one batch.
+    """
+    positions = trial.answer
+    if not isinstance(positions, list):
+        logger.info(f"Trial {trial.id} has no positions to store: {positions}")
+        return
+    db.session.add_all([
+        ForagerSlot(
+            network_id=trial.network_id,
+            degree=trial.degree,
+            slot=slot,
+            role=COORDINATOR_ROLE,
+            trial_id=trial.id,
+            participant_id=trial.participant_id,
+            position=position,
+        )
+        for slot, position in enumerate(positions)
+    ])
+
+
+def write_forager_slot(
+        trial,
+        slot: int,
+        position: Union[int, None],
+        target_id: Union[int, None],
+    ) -> None:
+    db.session.add(
+        ForagerSlot(
+            network_id=trial.network_id,
+            degree=trial.degree,
+            slot=slot,
+            role=FORAGER_ROLE,
+            trial_id=trial.id,
+            participant_id=trial.participant_id,
+            position=position,
+            target_id=target_id,
+        )
+    )
+
+
+###########################################
+# Aggregate queries
+###########################################
+
+def get_positions(network_id: int, role: str = COORDINATOR_ROLE) -> List[Tuple[int, int, int]]:
+    """
+    Returns (degree, slot, position) tuples for the non-failed trials of a
+    chain, ordered by generation and slot.
+    """
+    rows = (
+        db.session.query(ForagerSlot.degree, ForagerSlot.slot, ForagerSlot.position)
+        .join(Info, Info.id == ForagerSlot.trial_id)
+        .filter(
+            ForagerSlot.network_id == network_id,
+            ForagerSlot.role == role,
+            Info.failed == False,  # noqa: E712
+        )
+        .order_by(ForagerSlot.degree, ForagerSlot.slot)
+        .all()
+    )
+    return [tuple(row) for row in rows]
+
+
+def count_selections(network_id: int) -> List[Tuple[int, int, int]]:
+    """
+    Returns (degree, target_id, count) tuples with how many non-failed
+    foragers selected each target in every generation of a chain.
+    """
+    rows = (
+        db.session.query(
+            ForagerSlot.degree,
+            ForagerSlot.target_id,
+            func.count(ForagerSlot.id),
+        )
+        .join(Info, Info.id == ForagerSlot.trial_id)
+        .filter(
+            ForagerSlot.network_id == network_id,
+            ForagerSlot.role == FORAGER_ROLE,
+            Info.failed == False,  # noqa: E712
+        )
+        .group_by(ForagerSlot.degree, ForagerSlot.target_id)
+        .order_by(ForagerSlot.degree)
+        .all()
+    )
+    return [tuple(row) for row in rows]
+
+###########################################
@@ -0,0 +1,344 @@
+# Offline re-check of recorded answers against the current experiment code
+#
+# Usage (from the experiment directory):
+#
+#   bash docker/run python replay.py path/to/export.zip --processes 4 --output replay.json
+#
+# This is not a full session replay: participants never typed into these pages
+# again. Each recorded answer is fed back through the page that the current
+# trial classes build for it, to check that it still parses and validates the
+# same way, and forager slots are recomputed with the current slot logic.
+# Nothing here touches the database, so the timings only cover building the
+# page and re-checking the answer; they are reported for information and are
+# not a measure of page latency on the server.
+
+##########################################################################################
+# Imports
+##########################################################################################
+
+import argparse
+import csv
+import importlib.util
+import io
+import json
+import os
+import statistics
+import sys
+import time
+import zipfile
+
+from collections import defaultdict
+from multiprocessing import Pool
+from types import SimpleNamespace
+from typing import (
+    List, Dict, Any, Tuple, Union
+)
+
+EXPERIMENT_PACKAGE = "dallinger_experiment"
+DEFAULT_REPEATS = 100
+
+experiment_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Set in each process by load_experiment
+experiment_module = None
+
+
+###########################################
+# Loading
+###########################################
+
+def load_experiment() -> None:
+    """
+    Imports experiment.py as part of the experiment package, the same way
+    Dallinger does, so that its relative imports resolve.
+    """
+    global experiment_module
+    if experiment_module is not None:
+        return
+    if EXPERIMENT_PACKAGE not in sys.modules:
+        spec = importlib.util.spec_from_file_location(
+            EXPERIMENT_PACKAGE,
+            os.path.join(experiment_dir, "__init__.py"),
+            submodule_search_locations=[experiment_dir],
+        )
+        package = importlib.util.module_from_spec(spec)
+        sys.modules[EXPERIMENT_PACKAGE] = package
+        spec.loader.exec_module(package)
+    experiment_module = importlib.import_module(f"{EXPERIMENT_PACKAGE}.experiment")
+
+
+def read_table(archive: zipfile.ZipFile, table: str) -> List[Dict[str, str]]:
+    with archive.open(f"data/{table}.csv") as f:
+        return list(csv.DictReader(io.TextIOWrapper(f, encoding="utf-8")))
+
+
+def class_name(row: Dict[str, str]) -> str:
+    return row["type"].rsplit(".", 1)[-1]
+
+
+def parse_json(value: str) -> Any:
+    if value == "":
+        return None
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def read_export(zip_path: str) -> List[Dict[str, Any]]:
+    """
+    Returns one bundle per participant with their recorded responses, their
+    trials, and for each trial its node, the coordinator trials of that node
+    (the targets a forager could choose from) and all its forager trials.
+    """
+    with zipfile.ZipFile(zip_path) as archive:
+        responses = read_table(archive, "response")
+        infos = read_table(archive, "info")
+        nodes = {row["id"]: row for row in read_table(archive, "node")}
+
+    coordinators = defaultdict(list)
+    foragers = defaultdict(list)
+    for row in infos:
+        if class_name(row) == "CoordinatorTrial" and row["failed"] == "f" and row["finalized"] == "t":
+            coordinators[row["node_id"]].append(row)
+        elif class_name(row) == "ForagerTrial":
+            foragers[row["node_id"]].append(row)
+
+    bundles = defaultdict(lambda: {"responses": [], "trials": {}})
+    for row in responses:
+        if row["participant_id"] != "":
+            bundles[int(row["participant_id"])]["responses"].append(row)
+    for row in infos:
+        if row["participant_id"] == "" or int(row["participant_id"]) not in bundles:
+            continue
+        bundles[int(row["participant_id"])]["trials"][class_name(row)] = {
+            "trial": row,
+            "node": nodes.get(row["node_id"]),
+            "coordinators": coordinators[row["node_id"]],
+            "foragers": sorted(foragers[row["node_id"]], key=lambda r: int(r["id"])),
+        }
+
+    result = []
+    for participant_id, bundle in sorted(bundles.items()):
+        bundle["responses"].sort(key=lambda row: (row["creation_time"], int(row["id"])))
+        result.append({"participant_id": participant_id, **bundle})
+    return result
+
+
+###########################################
+# Rebuilding pages
+###########################################
+
+def forager_slots_before(trial: Dict[str, str], foragers: List[Dict[str, str]]) -> List[Tuple[int, Any]]:
+    """
+    The (trial id, slot) pairs the slot logic saw when ``trial`` started:
+    earlier forager trials of the node that had not failed by then, with
+    their recorded slots, and ``trial`` itself without one.
+    """
+    seen = []
+    for row in foragers:
+        if int(row["id"]) >= int(trial["id"]):
+            continue
+        if row["failed"] == "t" and row["time_of_death"] < trial["creation_time"]:
+            continue
+        seen.append((int(row["id"]), (parse_json(row["vars"]) or {}).get("forager_id")))
+    return seen + [(int(trial["id"]), None)]
+
+
+def target_label(row: Dict[str, str]) -> str:
+    # Same string as f"{target}" for a trial, see psynet.data.SQLMixinDallinger.__repr__
+    return f"Info-{row['id']}-{class_name(row)}"
+
+
+def raw_answer(answer: Any) -> str:
+    if isinstance(answer, list):
+        return ", ".join(str(a) for a in answer)
+    return f"{answer}"
+
+
+def coordinator_page(recorded: Any, trials: Dict[str, Any]) -> Tuple[Any, Any, List[Dict[str, Any]]]:
+    m = experiment_module
+    context = parse_json(trials["CoordinatorTrial"]["node"]["context"])
+    page = m.CoordinatorTrial.assign_foragers_page(context)
+    return page, raw_answer(recorded), []
+
+
+def forager_page(recorded: Any, trials: Dict[str, Any]) -> Tuple[Any, Any, List[Dict[str, Any]]]:
+    m = experiment_module
+    bundle = trials["ForagerTrial"]
+    context = parse_json(bundle["node"]["context"])
+    trial_vars = parse_json(bundle["trial"]["vars"]) or {}
+    diffs = []
+
+    if len(bundle["coordinators"]) != 1:
+        diffs.append({"field": "targets", "recorded": len(bundle["coordinators"]), "replayed": 1})
+        return None, recorded, diffs
+    positions = parse_json(bundle["coordinators"][0]["answer"])
+    forager_id = m.ForagerTrial.pick_forager_slot(
+        int(bundle["trial"]["id"]),
+        forager_slots_before(bundle["trial"], bundle["foragers"]),
+    )
+    location = positions[forager_id]
+    for field, replayed in [("forager_id", forager_id), ("location", location)]:
+        if trial_vars.get(field) != replayed:
+            diffs.append({"field": field, "recorded": trial_vars.get(field), "replayed": replayed})
+
+    choices = [target_label(row) for row in bundle["coordinators"]]
+    page = m.ForagerTrial.forager_turn_page(context=context, location=location, choices=choices)
+    return page, recorded, diffs
+
+
+PAGE_BUILDERS = {
+    "create_trial": ("CoordinatorTrial", coordinator_page),
+    "forager_turn": ("ForagerTrial", forager_page),
+}
+
+
+###########################################
+# Re-checking answers
+###########################################
+
+def check_answer(page, raw: Any) -> Tuple[Any, bool]:
+    answer = page.format_answer(raw)
+    validation = page.validate(SimpleNamespace(answer=answer))
+    return answer, not isinstance(validation, experiment_module.FailedValidation)
+
+
+def replay_response(row: Dict[str, str], trials: Dict[str, Any], repeats: int) -> Dict[str, Any]:
+    recorded = parse_json(row["answer"])
+    result = {
+        "response_id": int(row["id"]),
+        "question": row["question"],
+        "replayed": False,
+        "diffs": [],
+    }
+    if row["question"] not in PAGE_BUILDERS:
+        return result
+    trial_class, build = PAGE_BUILDERS[row["question"]]
+    if trials.get(trial_class, {}).get("node") is None:
+        return result
+
+    page, raw, diffs = build(recorded, trials)
+    if page is None:
+        result["diffs"] = diffs
+        return result
+    answer, valid = check_answer(page, raw)
+
+    times_ms = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        check_answer(build(recorded, trials)[0], raw)
+        times_ms.append((time.perf_counter() - start) * 1000)
+    result["time_ms"] = statistics.median(times_ms)
+    result["replayed"] = True
+
+    result["diffs"] = diffs
+    if answer != recorded:
+        result["diffs"].append({"field": "answer", "recorded": recorded, "replayed": answer})
+    if row["successful_validation"] != "":
+        recorded_valid = row["successful_validation"] == "t"
+        if recorded_valid != valid:
+            result["diffs"].append(
+                {"field": "successful_validation", "recorded": recorded_valid, "replayed": valid}
+            )
+    return result
+
+
+def replay_participant(item: Tuple[Dict[str, Any], int]) -> Dict[str, Any]:
+    # Loaded here rather than in a pool initializer, so that import errors
+    # come back through Pool.map instead of respawning workers forever
+    load_experiment()
+    bundle, repeats = item
+    return {
+        "participant_id": bundle["participant_id"],
+        "responses": [
+            replay_response(row, bundle["trials"], repeats)
+            for row in bundle["responses"]
+        ],
+    }
+
+
+def replay(
+        zip_path: str,
+        processes: Union[int, None] = None,
+        repeats: int = DEFAULT_REPEATS,
+    ) -> List[Dict[str, Any]]:
+    # Fail fast on broken experiment code before starting any worker
+    load_experiment()
+    bundles = read_export(zip_path)
+    with Pool(processes=processes) as pool:
+        return pool.map(replay_participant, [(bundle, repeats) for bundle in bundles])
+
+
+###########################################
+# Report
+###########################################
+
+def page_timings(results: List[Dict[str, Any]]) -> Dict[str, float]:
+    """
+    Returns, for each page, the median over responses of the median time
+    in milliseconds taken to build the page and re-check an answer.
+    """
+    times = defaultdict(list)
+    for participant in results:
+        for response in participant["responses"]:
+            if response["replayed"]:
+                times[response["question"]].append(response["time_ms"])
+    return {question: statistics.median(t) for question, t in times.items()}
+
+
+def make_report(results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    diffs = [
+        {"participant_id": p["participant_id"], **response}
+        for p in results
+        for response in p["responses"]
+        if len(response["diffs"]) > 0
+    ]
+    n_responses = sum(len(p["responses"]) for p in results)
+    n_replayed = sum(r["replayed"] for p in results for r in p["responses"])
+    timings = page_timings(results)
+    return {
+        "check": (
+            "recorded answers re-parsed and validated by the current pages, and forager "
+            "slots recomputed (not a full session replay)"
+        ),
+        "n_participants": len(results),
+        "n_responses": n_responses,
+        "n_replayed": n_replayed,
+        "diffs": diffs,
+        # Offline microbenchmark, not server latency
+        "page_timings_ms": timings,
+    }
+
+
+def main(argv: Union[List[str], None] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Re-check recorded answers from an exported database against the current experiment code."
+    )
+    parser.add_argument("database", help="Exported database zip, e.g. .deploy/database_template.zip")
+    parser.add_argument("--processes", type=int, default=None, help="Number of worker processes")
+    parser.add_argument("--repeats", type=int, default=DEFAULT_REPEATS,
+                        help="Times each page is rebuilt and re-checked to measure its median time")
+    parser.add_argument("--output", default=None, help="Where to write the JSON report")
+    args = parser.parse_args(argv)
+
+    results = replay(args.database, args.processes, args.repeats)
+    report = make_report(results)
+
+    print(
+        f"Re-checked {report['n_replayed']}/{report['n_responses']} recorded answers "
+        f"from {report['n_participants']} participants"
+    )
+    print(f"Behavioural diffs: {len(report['diffs'])}")
+    for question, t in report["page_timings_ms"].items():
+        print(f"  {question}: {t:.3f} ms (median, offline)")
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, default=str)
+
+    return 1 if report["diffs"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,148 @@
+# Tests for the Redis-backed slot counter.
+#
+# These need the Redis service that the Docker setup provides:
+#
+# bash docker/run pytest test_admission_control.py
+
+import pytest
+
+from .admission_control import (
+    ADMITTED,
+    FULL,
+    WAITING,
+    SlotCounter,
+)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def working():
+    return set()
+
+
+@pytest.fixture
+def make_counter(clock, working):
+    counters = []
+
+    def make(capacity=4, concurrent_slots=2, **kwargs):
+        counter = SlotCounter(
+            f"test_{len(counters)}",
+            capacity=capacity,
+            concurrent_slots=concurrent_slots,
+            lease_s=60.0,
+            stale_s=10.0,
+            default_duration_s=30.0,
+            is_working=lambda pid: pid in working,
+            clock=clock,
+            **kwargs,
+        )
+        counter.reset()
+        counters.append(counter)
+        return counter
+
+    yield make
+    for counter in counters:
+        counter.reset()
+
+
+def test_capacity(make_counter):
+    counter = make_counter(capacity=3, concurrent_slots=3)
+    assert [counter.try_admit(pid) for pid in [1, 2, 3]] == [ADMITTED] * 3
+    for pid in [1, 2, 3]:
+        counter.release(pid)
+    assert counter.try_admit(4) == FULL
+
+
+def test_admission_is_idempotent(make_counter):
+    counter = make_counter(capacity=2, concurrent_slots=1)
+    assert counter.try_admit(1) == ADMITTED
+    assert counter.try_admit(1) == ADMITTED
+    assert counter.try_admit(2) == WAITING
+
+
+def test_waiting_room_is_fifo(make_counter):
+    counter = make_counter(capacity=4, concurrent_slots=1)
+    assert counter.try_admit(1) == ADMITTED
+    assert counter.try_admit(2) == WAITING
+    assert counter.try_admit(3) == WAITING
+    counter.release(1)
+    # 3 polls first but 2 arrived earlier
+    assert counter.try_admit(3) == WAITING
+    assert counter.try_admit(2) == ADMITTED
+    counter.release(2)
+    assert counter.try_admit(3) == ADMITTED
+
+
+def test_stale_waiting_participants_leave_the_queue(make_counter, clock):
+    counter = make_counter(capacity=4, concurrent_slots=1)
+    assert counter.try_admit(1) == ADMITTED
+    assert counter.try_admit(2) == WAITING
+    clock.now += 5
+    assert counter.try_admit(3) == WAITING
+    clock.now += 6
+    counter.release(1)
+    assert counter.try_admit(3) == ADMITTED
+
+
+def test_expired_lease_is_kept_while_working(make_counter, clock, working):
+    counter = make_counter(capacity=4, concurrent_slots=1)
+    working.add(1)
+    assert counter.try_admit(1) == ADMITTED
+    clock.now += 120
+    assert counter.try_admit(2) == WAITING
+    counter.release(1)
+    assert counter.try_admit(2) == ADMITTED
+
+
+def test_expired_lease_is_freed_when_abandoned(make_counter, clock):
+    counter = make_counter(capacity=2, concurrent_slots=1)
+    assert counter.try_admit(1) == ADMITTED
+    clock.now += 120
+    assert counter.try_admit(2) == ADMITTED
+    counter.release(2)
+    # The abandoned participant does not count towards capacity
+    assert counter.try_admit(3) == ADMITTED
+
+
+def test_estimated_wait(make_counter, clock):
+    counter = make_counter(capacity=10, concurrent_slots=1)
+    assert counter.try_admit(1) == ADMITTED
+    assert counter.try_admit(2) == WAITING
+    assert counter.try_admit(3) == WAITING
+    assert counter.estimated_wait(2) == 30.0
+    assert counter.estimated_wait(3) == 60.0
+    clock.now += 4
+    counter.release(1)
+    assert counter.estimated_wait(3) == 8.0
+
+
+def test_release_without_trial_frees_the_slot(make_counter):
+    counter = make_counter(capacity=2, concurrent_slots=2)
+    assert counter.try_admit(1) == ADMITTED
+    assert counter.try_admit(2) == ADMITTED
+    counter.release(1, completed=False)
+    counter.release(2, completed=True)
+    assert not counter.is_full()
+    assert counter.try_admit(3) == ADMITTED
+    assert counter.is_full()
+
+
+def test_open_slots_limit_admission(make_counter):
+    counter = make_counter(capacity=8, concurrent_slots=4)
+    assert counter.try_admit(1, open_slots=1) == ADMITTED
+    assert counter.try_admit(2, open_slots=1) == WAITING
+    assert counter.try_admit(3, open_slots=1) == WAITING
+    assert counter.try_admit(2, open_slots=4) == ADMITTED
+    assert counter.try_admit(3, open_slots=4) == ADMITTED
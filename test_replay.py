@@ -0,0 +1,195 @@
+# Tests for the offline re-check of recorded answers.
+#
+# These use small stand-ins for the experiment's page classes, so they run
+# without a server:
+#
+# bash docker/run pytest test_replay.py
+
+import csv
+import io
+import json
+import re
+import zipfile
+
+from types import SimpleNamespace
+
+import pytest
+
+from . import replay
+
+NUM_FORAGERS = 3
+
+COLUMNS = {
+    "response": ["id", "creation_time", "participant_id", "question", "answer", "successful_validation"],
+    "info": [
+        "id", "creation_time", "type", "participant_id", "node_id", "failed",
+        "time_of_death", "finalized", "answer", "vars",
+    ],
+    "node": ["id", "context"],
+}
+
+
+class FailedValidation:
+    pass
+
+
+class AssignForagersPage:
+    def format_answer(self, raw_answer):
+        numbers = [int(n) for n in re.findall(r"-?\d+", raw_answer)]
+        return numbers if len(numbers) == NUM_FORAGERS else "INVALID_RESPONSE"
+
+    def validate(self, response):
+        if response.answer == "INVALID_RESPONSE":
+            return FailedValidation()
+        return None
+
+
+class ForagerTurnPage:
+    def __init__(self, choices):
+        self.control = SimpleNamespace(choices=choices)
+
+    def format_answer(self, raw_answer):
+        return raw_answer
+
+    def validate(self, response):
+        return None
+
+
+def pick_forager_slot(trial_id, foragers):
+    taken = {slot for _, slot in foragers if slot is not None}
+    free = [slot for slot in range(NUM_FORAGERS) if slot not in taken]
+    unassigned = sorted(id_ for id_, slot in foragers if slot is None)
+    return free[unassigned.index(trial_id)]
+
+
+@pytest.fixture
+def experiment(monkeypatch):
+    module = SimpleNamespace(
+        FailedValidation=FailedValidation,
+        CoordinatorTrial=SimpleNamespace(
+            assign_foragers_page=lambda context: AssignForagersPage(),
+        ),
+        ForagerTrial=SimpleNamespace(
+            forager_turn_page=lambda context, location, choices: ForagerTurnPage(choices),
+            pick_forager_slot=pick_forager_slot,
+        ),
+    )
+    monkeypatch.setattr(replay, "experiment_module", module)
+    return module
+
+
+def write_export(path, tables):
+    with zipfile.ZipFile(path, "w") as archive:
+        for table, columns in COLUMNS.items():
+            f = io.StringIO()
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            for row in tables.get(table, []):
+                writer.writerow({column: row.get(column, "") for column in columns})
+            archive.writestr(f"data/{table}.csv", f.getvalue())
+    return str(path)
+
+
+def trial(id_, cls, participant_id, answer, vars_=None, failed="f", time_of_death=""):
+    return {
+        "id": id_,
+        "creation_time": f"2025-01-01 00:00:{id_:02d}",
+        "type": f"dallinger_experiment.experiment.{cls}",
+        "participant_id": participant_id,
+        "node_id": 1,
+        "failed": failed,
+        "time_of_death": time_of_death,
+        "finalized": "t",
+        "answer": json.dumps(answer),
+        "vars": json.dumps(vars_ or {}),
+    }
+
+
+def response(id_, participant_id, question, answer, valid="t"):
+    return {
+        "id": id_,
+        "creation_time": f"2025-01-01 00:01:{id_:02d}",
+        "participant_id": participant_id,
+        "question": question,
+        "answer": json.dumps(answer),
+        "successful_validation": valid,
+    }
+
+
+@pytest.fixture
+def export(tmp_path):
+    label = "Info-1-CoordinatorTrial"
+    return write_export(tmp_path / "export.zip", {
+        "node": [{"id": 1, "context": json.dumps({"img_url": "static/positioning.png"})}],
+        "info": [
+            trial(1, "CoordinatorTrial", 1, [10, 20, 30]),
+            trial(2, "ForagerTrial", 2, label, {"forager_id": 0, "location": 10},
+                  failed="t", time_of_death="2025-01-01 00:00:03"),
+            trial(4, "ForagerTrial", 3, label, {"forager_id": 0, "location": 10}),
+            trial(5, "ForagerTrial", 4, label, {"forager_id": 2, "location": 30}),
+        ],
+        "response": [
+            response(2, 1, "test_custom_front_end", None, valid=""),
+            response(1, 1, "create_trial", [10, 20, 30]),
+            response(3, 3, "forager_turn", label),
+            response(4, 4, "forager_turn", label),
+        ],
+    })
+
+
+def test_read_export(export):
+    bundles = replay.read_export(export)
+    assert [b["participant_id"] for b in bundles] == [1, 3, 4]
+    coordinator = bundles[0]
+    assert [r["question"] for r in coordinator["responses"]] == ["create_trial", "test_custom_front_end"]
+    forager = bundles[1]["trials"]["ForagerTrial"]
+    assert [r["id"] for r in forager["coordinators"]] == ["1"]
+    assert [r["id"] for r in forager["foragers"]] == ["2", "4", "5"]
+    assert json.loads(forager["node"]["context"]) == {"img_url": "static/positioning.png"}
+
+
+def test_replay_coordinator_answer(experiment, export):
+    bundle = replay.read_export(export)[0]
+    result = replay.replay_response(bundle["responses"][0], bundle["trials"], repeats=3)
+    assert result["replayed"]
+    assert result["diffs"] == []
+    assert result["time_ms"] >= 0
+
+
+def test_replay_detects_changed_parsing(experiment, export, monkeypatch):
+    monkeypatch.setattr(AssignForagersPage, "format_answer", lambda self, raw_answer: raw_answer)
+    bundle = replay.read_export(export)[0]
+    result = replay.replay_response(bundle["responses"][0], bundle["trials"], repeats=1)
+    assert [d["field"] for d in result["diffs"]] == ["answer"]
+
+
+def test_replay_skips_unknown_pages(experiment, export):
+    bundle = replay.read_export(export)[0]
+    result = replay.replay_response(bundle["responses"][1], bundle["trials"], repeats=1)
+    assert not result["replayed"]
+
+
+def test_replay_recomputes_forager_slots(experiment, export):
+    bundles = replay.read_export(export)
+    # Trial 2 failed before trial 4 started, so trial 4 takes slot 0 again
+    first = replay.replay_response(bundles[1]["responses"][0], bundles[1]["trials"], repeats=1)
+    assert first["diffs"] == []
+    # Trial 5 recorded slot 2, but the current logic gives it slot 1
+    second = replay.replay_response(bundles[2]["responses"][0], bundles[2]["trials"], repeats=1)
+    assert {d["field"]: d["replayed"] for d in second["diffs"]} == {"forager_id": 1, "location": 20}
+
+
+def test_make_report(experiment, export):
+    results = [
+        {
+            "participant_id": b["participant_id"],
+            "responses": [replay.replay_response(r, b["trials"], repeats=1) for r in b["responses"]],
+        }
+        for b in replay.read_export(export)
+    ]
+    report = replay.make_report(results)
+    assert report["n_participants"] == 3
+    assert report["n_responses"] == 4
+    assert report["n_replayed"] == 3
+    assert [d["participant_id"] for d in report["diffs"]] == [4]
+    assert set(report["page_timings_ms"]) == {"create_trial", "forager_turn"}